@@ -2,8 +2,12 @@
 # Licensed under the MIT License.
 """A function app to manage an RPM repository in Azure Blob Storage."""
 
+import functools
 import logging
 import os
+import re
+from pathlib import Path
+from typing import Optional
 
 import azure.functions as func
 from azure.identity import DefaultAzureCredential
@@ -14,6 +18,7 @@ from rpm_package_function import (
     AzureDistributionRepository,
     AzureFlatRepository,
 )
+from rpm_package_function.utils import create_transport
 
 app = func.FunctionApp()
 log = logging.getLogger("rpm-package-function")
@@ -28,30 +33,55 @@ CONTAINER_NAME = os.environ["BLOB_CONTAINER"]
 UPLOAD_DIRECTORY = os.environ.get("UPLOAD_DIRECTORY", "upload")
 REPO_TYPE = os.environ.get("REPO_TYPE", "distribution")
 
+# Size of each ranged GET made when downloading blobs in parallel.
+MAX_CHUNK_GET_SIZE = 16 * 1024 * 1024
 
-@app.function_name(name="eventGridTrigger")
-@app.event_grid_trigger(arg_name="event")
-def event_grid_trigger(event: func.EventGridEvent):
-    """Process an event grid trigger for a new blob in the container."""
-    log.info("Processing event %s", event.id)
+# Number of connections to the storage account kept open for reuse. Blobs are
+# transferred on many threads at once, which would overflow the requests
+# default of 10 and cause connections to be discarded and re-established.
+CONNECTION_POOL_SIZE = 64
 
-    container_client: ContainerClient
+# The subject of a blob event is of the form
+# /blobServices/default/containers/<container>/blobs/<blob path>
+SUBJECT_RE = re.compile(r"^/blobServices/default/containers/[^/]+/blobs/(.+)$")
 
+
+@functools.lru_cache(maxsize=None)
+def get_container_client() -> ContainerClient:
+    """Get a ContainerClient for the package container.
+
+    The client is created once and reused by every invocation handled by this
+    process, so that its credential and connections are shared.
+    """
     if "AzureWebJobsStorage" in os.environ:
         # Use a connection string to access the storage account
         connection_string = os.environ["AzureWebJobsStorage"]
-        container_client = ContainerClient.from_connection_string(
-            conn_str=connection_string, container_name=CONTAINER_NAME
-        )
-    else:
-        # Use credentials to access the container. Used when shared-key
-        # access is disabled.
-        credential = DefaultAzureCredential()
-        container_client = ContainerClient.from_container_url(
-            container_url=os.environ["BLOB_CONTAINER_URL"],
-            credential=credential,
+        return ContainerClient.from_connection_string(
+            conn_str=connection_string,
+            container_name=CONTAINER_NAME,
+            max_chunk_get_size=MAX_CHUNK_GET_SIZE,
+            transport=create_transport(CONNECTION_POOL_SIZE),
         )
 
+    # Use credentials to access the container. Used when shared-key
+    # access is disabled.
+    credential = DefaultAzureCredential()
+    return ContainerClient.from_container_url(
+        container_url=os.environ["BLOB_CONTAINER_URL"],
+        credential=credential,
+        max_chunk_get_size=MAX_CHUNK_GET_SIZE,
+        transport=create_transport(CONNECTION_POOL_SIZE),
+    )
+
+
+@app.function_name(name="eventGridTrigger")
+@app.event_grid_trigger(arg_name="event")
+def event_grid_trigger(event: func.EventGridEvent):
+    """Process an event grid trigger for a new blob in the container."""
+    log.info("Processing event %s", event.id)
+
+    container_client = get_container_client()
+
     # Create a repository object based on the repo type
     repo: AzureBaseRepository
 
@@ -64,7 +94,14 @@ def event_grid_trigger(event: func.EventGridEvent):
     else:
         raise ValueError(f"Invalid repo type: {REPO_TYPE}")
 
-    # Process the event
-    repo.process()
+    # Process the event. Only the part of the repository affected by the blob
+    # needs processing; if the blob can't be determined, process everything.
+    changed_blob: Optional[Path] = None
+    if m := SUBJECT_RE.match(event.subject):
+        changed_blob = Path(m.group(1))
+    else:
+        log.warning("Unable to determine blob from subject: %s", event.subject)
+
+    repo.process(changed_blob)
 
     log.info("Done processing event %s", event.id)
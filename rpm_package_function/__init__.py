@@ -13,6 +13,7 @@ from .repomanager import (
     AzureBaseRepository,
     AzureDistributionRepository,
     AzureFlatRepository,
+    ProcessResult,
 )
 from .rpmpackage import BaseRpmPackage, LocalRpmPackage, RemoteRpmPackage
 
@@ -26,5 +27,6 @@ __all__ = [
     "DistributionOrganiser",
     "FlatOrganiser",
     "LocalRpmPackage",
+    "ProcessResult",
     "RemoteRpmPackage",
 ]
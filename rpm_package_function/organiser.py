@@ -3,10 +3,11 @@
 """Classes to organise RPM packages."""
 
 
+import functools
 import logging
 import re
 from pathlib import Path
-from typing import Callable, List
+from typing import Callable, List, Optional, Tuple
 
 from azure.storage.blob import ContainerClient
 
@@ -15,10 +16,32 @@ from rpm_package_function.rpmpackage import (
     LocalRpmPackage,
     RemoteRpmPackage,
 )
+from rpm_package_function.utils import LIST_PAGE_SIZE
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# Attempt to split up the distribution into components. Most
+# distributions that have a distribution use a two digit letter code
+# followed by a version number.
+# A few examples:
+# - fc34: Fedora 34
+# - el7: RHEL 7
+# - cm2: AzureLinux 2
+_DIST_RE = re.compile(r"^([a-z]+)(\d+)$")
+
+
+@functools.lru_cache(maxsize=None)
+def _split_distribution(distribution: str) -> Optional[Tuple[str, str]]:
+    """Split a distribution into its letters and version number.
+
+    A repository holds packages for only a handful of distributions, so each
+    one is only split once.
+    """
+    if m := _DIST_RE.match(distribution):
+        return m.group(1), m.group(2)
+    return None
+
 
 class BaseOrganiser:
     """Base class for organising RPM packages."""
@@ -80,21 +103,24 @@ class AzureOrganiserMixin:
 
     def list_uploads(self) -> List[BaseRpmPackage]:
         """List the uploaded packages."""
-        # List the blobs in the container prefixed with the upload directory
+        # List the blobs in the container under the upload directory. The
+        # trailing slash stops this matching e.g. "uploads-old/" as well.
         blobs = self.container_client.list_blobs(
-            name_starts_with=str(self.upload_directory)
+            name_starts_with=f"{self.upload_directory}/",
+            results_per_page=LIST_PAGE_SIZE,
         )
 
         packages: list[BaseRpmPackage] = []
 
         for blob in blobs:
-            blob_path = Path(blob.name)
-            if blob_path.suffix != ".rpm":
+            if not blob.name.endswith(".rpm"):
                 log.info("Skipping non-RPM blob: %s", blob)
                 continue
 
             # Create a new RemoteRpmPackage object
-            package = RemoteRpmPackage(blob_path, self.container_client)
+            package = RemoteRpmPackage(
+                Path(blob.name), self.container_client, etag=blob.etag
+            )
             packages.append(package)
 
         log.info("Found %d packages in %s", len(packages), self.upload_directory)
@@ -103,16 +129,32 @@ class AzureOrganiserMixin:
 
     def organise(self) -> None:
         """Organise the uploaded packages."""
-        for package in self.list_uploads():
-            log.debug("Organising package: %s", package)
-            path = self.get_path(package)
+        packages = [
+            package
+            for package in self.list_uploads()
+            if isinstance(package, RemoteRpmPackage)
+        ]
 
-            # Move the package to the new path
+        # Read all of the package headers up front, rather than one at a time
+        # as each package is organised.
+        RemoteRpmPackage.prefetch_many(packages, headers_only=True)
+
+        for package in packages:
+            log.debug("Organising package: %s", package)
             try:
-                package.move(str(path))
+                path = self.get_path(package)
+
+                # Move the package to the new path. The copy fails if there's
+                # already a package there, so there's no need to check first.
+                package.move(str(path), check_exists=False)
             except FileExistsError as e:
                 # If the file already exists, log a warning and continue
                 log.warning("File already exists: %s", e)
+            except Exception as e:  # pylint: disable=broad-except
+                # Don't let one bad upload stop the others being organised
+                log.error("Failed to organise %s: %s", package, e)
+            finally:
+                package.discard_local()
 
     get_path: Callable[[BaseRpmPackage], Path]
 
@@ -134,17 +176,9 @@ class DistributionPathMixin:
         filename = f"{name}-{version}-{release}.{arch}.rpm"
         log.debug("Normalised filename: %s", filename)
 
-        # Attempt to split up the distribution into components. Most
-        # distributions that have a distribution use a two digit letter code
-        # followed by a version number.
-        # A few examples:
-        # - fc34: Fedora 34
-        # - el7: RHEL 7
-        # - cm2: AzureLinux 2
-        pattern = r"^([a-z]+)(\d+)$"
-
-        if distribution and (m := re.match(pattern, distribution)):
-            path = self.root / m.group(1) / m.group(2) / filename
+        # Split the distribution into its letters and version number.
+        if distribution and (parts := _split_distribution(distribution)):
+            path = self.root.joinpath(*parts, filename)
         else:
             # If we don't have a distribution, put it in the "rejected" directory.
             path = self.root / "rejected" / filename
@@ -2,28 +2,79 @@
 # Licensed under the MIT License.
 """Classes to manage repositories."""
 
+import hashlib
 import logging
+import os
 import tarfile
 import tempfile
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Set, Union
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import createrepo_c
-from azure.storage.blob import ContainerClient
+from azure.storage.blob import BlobPrefix, BlobProperties, ContainerClient
 
 from rpm_package_function import AzureDistributionOrganiser, AzureFlatOrganiser
 from rpm_package_function.rpmpackage import RemoteRpmPackage
+from rpm_package_function.utils import LIST_PAGE_SIZE, chunks, concurrent_map
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 METADATA_CHECK_KEY = "RpmLastModified"
 
+# Recorded on repomd.xml to identify the package metadata it was merged from.
+FINGERPRINT_KEY = "RpmMetadataFingerprint"
+
+# The maximum number of listings or metadata downloads to run at the same time.
+MAX_CONCURRENCY = 32
+
+# The number of parallel connections to use when transferring a single blob.
+BLOB_MAX_CONCURRENCY = 4
+
+# The number of repodata files to upload at the same time, across all paths.
+REPODATA_UPLOAD_CONCURRENCY = 8
+
+# The number of stale packages to download ahead of generating their metadata.
+STALE_DOWNLOAD_CONCURRENCY = 8
+
+# The maximum number of sub-requests allowed in a single blob batch request.
+MAX_BATCH_SIZE = 256
+
+# The size at which in-memory metadata tarballs are spilled to disk.
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+# The outcome of processing a repository: whether any package metadata had to be
+# generated, and whether any repository metadata was regenerated.
+ProcessResult = namedtuple(
+    "ProcessResult", ["packages_changed", "repodata_regenerated"]
+)
+
+
+def _metadata_fingerprint(metadata_versions: Dict[str, str]) -> str:
+    """Get a fingerprint for a set of metadata files and their package versions."""
+    digest = hashlib.sha256()
+    for name, version in sorted(metadata_versions.items()):
+        digest.update(f"{name}\0{version}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _merge_share(concurrency: int) -> int:
+    """Get one merge's share of a concurrency limit.
+
+    A merge runs on each core at once, so each gets a share of the limit rather
+    than all of it, keeping the total number of transfers within the limit.
+    """
+    return max(1, concurrency // (os.cpu_count() or 1))
+
 
 class BaseRepository:
     """Base class for repositories."""
 
-    def process(self) -> None:
+    def process(self, changed_blob: Optional[Path] = None) -> ProcessResult:
         """Run upkeep operations on the repository."""
         raise NotImplementedError
 
@@ -40,31 +91,227 @@ class AzureBaseRepository(BaseRepository):
         self.container_client = container_client
         self.organiser = organiser
 
-    def process(self) -> None:
-        """Run upkeep operations on the repository."""
-        log.info("Processing repository")
-        # First, organise any uploaded packages
-        self.organiser.organise()
+    def process(self, changed_blob: Optional[Path] = None) -> ProcessResult:
+        """Run upkeep operations on the repository.
+
+        If `changed_blob` is given, only the part of the repository affected by
+        that blob is processed. Repository metadata is only regenerated for
+        paths whose package metadata has changed since it was last generated.
+        """
+        blobs: List[BlobProperties]
+
+        if changed_blob is None:
+            log.info("Processing repository")
+            # First, organise any uploaded packages
+            self.organiser.organise()
+
+            # Take a single listing of the container and work from that, rather
+            # than enumerating the whole container for every step.
+            blobs = self._snapshot_blobs()
+
+        elif self.organiser.upload_directory in changed_blob.parents:
+            # Organising the package creates it in its final path, which in
+            # turn triggers processing of that path. Uploads may be nested in
+            # subdirectories of the upload directory.
+            log.info("Processing uploaded package %s", changed_blob)
+            self.organiser.organise()
+            return ProcessResult(False, False)
+
+        elif self._skip_blob(str(changed_blob)):
+            log.info("Nothing to process for %s", changed_blob)
+            return ProcessResult(False, False)
+
+        else:
+            log.info("Processing path %s for %s", changed_blob.parent, changed_blob)
+            blobs = self._snapshot_path_blobs(changed_blob.parent)
 
         # Next, regenerate repository metadata for packages that haven't had
         # it generated yet.
-        all_packages = self.list_all_packages()
+        all_packages = self.list_all_packages(blobs)
+        properties = {blob.name: blob for blob in blobs}
+        stale_packages = [
+            package
+            for package in all_packages
+            if not self.check_metadata(
+                package,
+                properties[str(package.path)],
+                properties.get(str(package.path.with_suffix(".package"))),
+            )
+        ]
+        log.info("%d packages need metadata generating", len(stale_packages))
+
+        # Generating metadata is CPU-bound, so run one createrepo_c per core.
+        # Meanwhile, download the packages on a separate pool so that the
+        # transfers happen while createrepo_c is running. Downloads only run a
+        # limited way ahead of metadata creation, so that only a bounded number
+        # of packages are on local disk at once.
+        with ThreadPoolExecutor(max_workers=STALE_DOWNLOAD_CONCURRENCY) as downloader:
+            prefetches: Dict[int, Future] = {}
+            prefetches_lock = threading.Lock()
+
+            def prefetch(index: int) -> None:
+                with prefetches_lock:
+                    if index < len(stale_packages) and index not in prefetches:
+                        prefetches[index] = downloader.submit(
+                            stale_packages[index].prefetch
+                        )
+
+            for index in range(STALE_DOWNLOAD_CONCURRENCY):
+                prefetch(index)
+
+            def create(index: int) -> None:
+                package = stale_packages[index]
+
+                # Make sure this package is being downloaded, and keep the
+                # downloads a fixed number of packages ahead.
+                prefetch(index)
+                prefetch(index + STALE_DOWNLOAD_CONCURRENCY)
+
+                try:
+                    prefetches[index].result()
+                    self.create_metadata(package, properties[str(package.path)])
+                finally:
+                    package.discard_local()
+
+            concurrent_map(create, range(len(stale_packages)), os.cpu_count() or 1)
+
+        # Every package now has a metadata file alongside it. Work out the
+        # metadata files in each path, including any created above which aren't
+        # in the listing, along with the package version each one describes
+        # and the repodata files that already exist.
+        metadata_versions: Dict[Path, Dict[str, str]] = defaultdict(dict)
+        repodata_names: Dict[Path, Set[str]] = defaultdict(set)
+
+        for blob in blobs:
+            if blob.name.endswith(".package"):
+                metadata_versions[Path(blob.name).parent][blob.name] = (
+                    blob.metadata or {}
+                ).get(METADATA_CHECK_KEY, "")
+                continue
+
+            parent, _, name = blob.name.rpartition("/")
+            if parent == "repodata" or parent.endswith("/repodata"):
+                repodata_names[Path(parent).parent].add(name)
+
         for package in all_packages:
-            self.check_metadata(package)
+            metadata_path = package.path.with_suffix(".package")
+            metadata_versions[metadata_path.parent][str(metadata_path)] = str(
+                properties[str(package.path)].last_modified
+            )
 
         # Now that all of the metadata is up to date, we can regenerate the
-        # repository metadata.
-        paths = self.list_all_package_paths()
-        for path in paths:
-            self.merge_metadata(path)
+        # repository metadata for any path where it has changed.
+        def merge(path: Path) -> bool:
+            fingerprint = _metadata_fingerprint(metadata_versions[path])
+            repomd = properties.get(str(path / "repodata" / "repomd.xml"))
+            if (
+                repomd is not None
+                and (repomd.metadata or {}).get(FINGERPRINT_KEY) == fingerprint
+            ):
+                log.info("Repository metadata for %s is up to date", path)
+                return False
+
+            self.merge_metadata(
+                path,
+                metadata_versions[path],
+                repodata_names[path],
+                fingerprint=fingerprint,
+            )
+            return True
+
+        # Merging runs mergerepo_c, which is CPU-bound, so like metadata
+        # creation, merge one path per core.
+        paths = self.list_all_package_paths(blobs)
+        merged = concurrent_map(merge, paths, os.cpu_count() or 1)
+
+        return ProcessResult(bool(stale_packages), any(merged))
+
+    def _snapshot_blobs(self) -> List[BlobProperties]:
+        """List the repository's blobs, along with their metadata."""
+        # The upload and rejected directories never contain repository
+        # packages, so don't ask the service to list them at all.
+        skipped_prefixes = {
+            f"{self.organiser.upload_directory}/",
+            f"{self.organiser.root / 'rejected'}/",
+        }
+
+        blobs: List[BlobProperties] = []
+        prefixes: List[str] = []
+
+        # Only list the part of the container under the repository's root.
+        root = self.organiser.root
+        root_prefix = f"{root}/" if root.parts else None
+
+        for item in self.container_client.walk_blobs(
+            name_starts_with=root_prefix,
+            include=["metadata"],
+            results_per_page=LIST_PAGE_SIZE,
+        ):
+            if isinstance(item, BlobPrefix):
+                if item.name in skipped_prefixes:
+                    log.debug("Not listing %s", item.name)
+                    continue
+                prefixes.append(item.name)
+            else:
+                blobs.append(item)
+
+        blobs.extend(self._parallel_list_blobs(prefixes))
+
+        log.info("Found %d blobs in the container", len(blobs))
+        return blobs
 
-    def _skip_blob(self, blob_name: Path) -> bool:
+    def _snapshot_path_blobs(self, path: Path) -> List[BlobProperties]:
+        """List the blobs in a single repository path, with their metadata."""
+        prefix = f"{path}/" if path.parts else ""
+
+        # List the packages and package metadata directly in the path, but not
+        # any of its subdirectories...
+        blobs = [
+            item
+            for item in self.container_client.walk_blobs(
+                name_starts_with=prefix or None,
+                include=["metadata"],
+                results_per_page=LIST_PAGE_SIZE,
+            )
+            if not isinstance(item, BlobPrefix)
+        ]
+
+        # ... apart from the existing repository metadata.
+        blobs.extend(
+            self.container_client.list_blobs(
+                name_starts_with=f"{prefix}repodata/",
+                include=["metadata"],
+                results_per_page=LIST_PAGE_SIZE,
+            )
+        )
+
+        log.info("Found %d blobs in %s", len(blobs), path)
+        return blobs
+
+    def _parallel_list_blobs(self, prefixes: List[str]) -> List[BlobProperties]:
+        """List the blobs under several prefixes at the same time."""
+        listings = concurrent_map(
+            lambda prefix: list(
+                self.container_client.list_blobs(
+                    name_starts_with=prefix,
+                    include=["metadata"],
+                    results_per_page=LIST_PAGE_SIZE,
+                )
+            ),
+            prefixes,
+            MAX_CONCURRENCY,
+        )
+        return [blob for listing in listings for blob in listing]
+
+    def _skip_blob(self, blob_name: str) -> bool:
         """Check if a blob should be skipped."""
-        if blob_name.suffix != ".rpm":
+        # Work on the raw blob name; this is called for every blob in the
+        # container, so avoid constructing a Path for each one.
+        if not blob_name.endswith(".rpm"):
             log.debug("Skipping non-RPM blob: %s", blob_name)
             return True
 
-        parent_parts = blob_name.parent.parts
+        parent_parts = blob_name.rsplit("/", 2)[:-1]
         if parent_parts and parent_parts[-1] == "upload":
             log.debug("Skipping upload package: %s", blob_name)
             return True
@@ -75,82 +322,84 @@ class AzureBaseRepository(BaseRepository):
 
         return False
 
-    def list_all_packages(self) -> List[RemoteRpmPackage]:
+    def list_all_packages(
+        self, blobs: Optional[List[BlobProperties]] = None
+    ) -> List[RemoteRpmPackage]:
         """List all packages in the repository."""
-        blobs = self.container_client.list_blobs()
+        if blobs is None:
+            blobs = self._snapshot_blobs()
 
         packages = []
 
         for blob in blobs:
-            blob_path = Path(blob.name)
-
-            if self._skip_blob(blob_path):
+            if self._skip_blob(blob.name):
                 continue
 
             # Create a new RemoteRpmPackage object
-            package = RemoteRpmPackage(blob_path, self.container_client)
+            package = RemoteRpmPackage(
+                Path(blob.name), self.container_client, etag=blob.etag
+            )
             packages.append(package)
 
         log.info("Found %d packages in total", len(packages))
         log.debug("Packages: %s", packages)
         return packages
 
-    def list_all_package_paths(self) -> Set[Path]:
+    def list_all_package_paths(
+        self, blobs: Optional[List[BlobProperties]] = None
+    ) -> Set[Path]:
         """List all package parents in the repository."""
-        blobs = self.container_client.list_blobs()
+        if blobs is None:
+            blobs = self._snapshot_blobs()
 
         paths: Set[Path] = set()
 
         for blob in blobs:
-            blob_path = Path(blob.name)
-            if self._skip_blob(blob_path):
+            if self._skip_blob(blob.name):
                 continue
 
-            paths.add(blob_path.parent)
+            paths.add(Path(blob.name).parent)
 
         log.info("Found %d paths in total", len(paths))
         log.debug("Paths: %s", paths)
         return paths
 
-    def check_metadata(self, package: RemoteRpmPackage) -> None:
-        """Check that package metadata exists and is correct."""
-        blob_client = package.blob_client()
-        metadata_path = package.path.with_suffix(".package")
-        metadata_blob_client = self.container_client.get_blob_client(str(metadata_path))
-
-        # Check if the metadata file exists and if it doesn't, create it
-        if not metadata_blob_client.exists():
+    def check_metadata(
+        self,
+        package: RemoteRpmPackage,
+        package_properties: BlobProperties,
+        metadata_properties: Optional[BlobProperties],
+    ) -> bool:
+        """Check whether package metadata exists and is up to date."""
+        # Check if the metadata file exists
+        if metadata_properties is None:
             log.error("Metadata file missing for: %s", package.path)
-            self.create_metadata(package)
-            return
+            return False
 
         # Check to make sure that the LastModified time of the package is the same as
         # the LastModified metadata variable on the metadata file.
-        package_properties = blob_client.get_blob_properties()
-        metadata_properties = metadata_blob_client.get_blob_properties()
+        metadata = metadata_properties.metadata or {}
 
-        if METADATA_CHECK_KEY not in metadata_properties.metadata:
+        if METADATA_CHECK_KEY not in metadata:
             log.error("Metadata file missing RpmLastModified for: %s", package.path)
-            self.create_metadata(package)
-            return
+            return False
 
-        if str(package_properties.last_modified) != str(
-            metadata_properties.metadata[METADATA_CHECK_KEY]
-        ):
+        if str(package_properties.last_modified) != str(metadata[METADATA_CHECK_KEY]):
             log.error(
                 "Metadata file out of date for: %s (%s != %s)",
                 package.path,
                 package_properties.last_modified,
-                metadata_properties.metadata[METADATA_CHECK_KEY],
+                metadata[METADATA_CHECK_KEY],
             )
-            self.create_metadata(package)
-            return
+            return False
 
         log.debug("Package %s metadata is up to date", package.path)
+        return True
 
     def create_metadata(
         self,
         package: RemoteRpmPackage,
+        package_properties: BlobProperties,
     ) -> None:
         """Create metadata information."""
         log.info("Creating metadata for package: %s", package.path)
@@ -166,8 +415,9 @@ class AzureBaseRepository(BaseRepository):
             # Generate the package structure.
             temp_package_path.parent.mkdir(parents=True, exist_ok=True)
 
-            # Copy the package to the temporary path
-            package.copy_local(temp_package_path)
+            # Move the downloaded package to the temporary path, rather than
+            # having two copies of it on disk.
+            package.move_local(temp_package_path)
 
             # Generate the repository metadata using the createrepo_c program
             log.debug("Generating metadata in %s", temp_root)
@@ -178,37 +428,90 @@ class AzureBaseRepository(BaseRepository):
             if rc != 0:
                 raise RuntimeError("Failed to generate metadata")
 
-            # Tar up the metadata
-            metadata_tar_gz = package.path.with_suffix(".tar.gz")
-
-            with tempfile.TemporaryDirectory() as temp_metadata_dir:
-                temp_metadata_file = Path(temp_metadata_dir) / metadata_tar_gz.name
-                with tarfile.open(temp_metadata_file, "w:gz") as tar:
+            # Tar up the metadata in memory, only spilling to disk if it's large.
+            # The repodata files are already compressed, so compressing the
+            # tarball as well costs CPU time for very little gain.
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as buf:
+                with tarfile.open(fileobj=buf, mode="w|") as tar:
                     tar.add(temp_root / "repodata", arcname="repodata")
 
-                log.debug("Created metadata tarball: %s", temp_metadata_file)
+                # Pass the length explicitly; otherwise the SDK asks for the
+                # file descriptor, which forces the buffer out to disk.
+                length = buf.tell()
+                buf.seek(0)
+                log.debug("Created %d byte metadata tarball", length)
 
-                # Upload the metadata to the container
+                # Upload the metadata to the container, recording the
+                # LastModified time of the package on the metadata file as
+                # part of the upload.
                 metadata_path = package.path.with_suffix(".package")
-                metadata_blob_client = self.container_client.get_blob_client(
-                    str(metadata_path)
+                metadata = {METADATA_CHECK_KEY: str(package_properties.last_modified)}
+                self.container_client.upload_blob(
+                    str(metadata_path),
+                    buf,
+                    length=length,
+                    overwrite=True,
+                    metadata=metadata,
+                    max_concurrency=BLOB_MAX_CONCURRENCY,
                 )
-                with open(temp_metadata_file, "rb") as f:
-                    metadata_blob_client.upload_blob(f, overwrite=True)
 
                 log.debug("Uploaded metadata to %s", metadata_path)
-
-                # Set the details on the uploaded metadata file.
-                blob_client = package.blob_client()
-                blob_properties = blob_client.get_blob_properties()
-                metadata = {METADATA_CHECK_KEY: str(blob_properties.last_modified)}
-                metadata_blob_client.set_blob_metadata(metadata)
                 log.debug(
                     "Set %s to %s", METADATA_CHECK_KEY, metadata[METADATA_CHECK_KEY]
                 )
 
-    def merge_metadata(self, path: Path) -> None:
-        """Merge metadata files."""
+    def _extract_metadata(self, blob_name: str, extract_root: Path) -> None:
+        """Download a metadata tarball and extract it, without saving the tarball."""
+        extract_root.mkdir(parents=True, exist_ok=True)
+
+        # Parallel downloads need a seekable target, which SpooledTemporaryFile
+        # only is from Python 3.11, so use an anonymous temporary file.
+        with tempfile.TemporaryFile() as buf:
+            stream = self.container_client.download_blob(
+                blob_name, max_concurrency=BLOB_MAX_CONCURRENCY
+            )
+            stream.readinto(buf)
+            buf.seek(0)
+
+            # Plain tarballs, and the gzipped tarballs from older versions.
+            with tarfile.open(fileobj=buf, mode="r:*") as tar:
+                tar.extractall(path=extract_root)
+
+        if not (extract_root / "repodata").exists():
+            raise FileNotFoundError("Failed to extract metadata")
+
+        log.debug("Extracted metadata %s to %s", blob_name, extract_root)
+
+    def _upload_file(
+        self,
+        local_path: str,
+        blob_name: str,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Upload a local file to a blob, overwriting it if it exists."""
+        with open(local_path, "rb") as f:
+            self.container_client.upload_blob(
+                blob_name,
+                f,
+                overwrite=True,
+                metadata=metadata,
+                max_concurrency=BLOB_MAX_CONCURRENCY,
+            )
+        log.debug("Uploaded %s to %s", local_path, blob_name)
+
+    def merge_metadata(
+        self,
+        path: Path,
+        metadata_names: Iterable[str],
+        existing_repodata: Iterable[str],
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        """Merge the given metadata files for a path.
+
+        `existing_repodata` is the names of the files currently in the path's
+        repodata directory; any that aren't regenerated are deleted. If given,
+        `fingerprint` is recorded on the new repomd.xml.
+        """
         log.info("Merging metadata for path: %s", path)
         # Create a temporary directory to work in
         with tempfile.TemporaryDirectory() as f:
@@ -219,50 +522,18 @@ class AzureBaseRepository(BaseRepository):
             package_dir.mkdir(parents=True, exist_ok=True)
             log.debug("Created package directory: %s", package_dir)
 
-            # Find all the metadata files under the given path
-            # If the path is empty, we want to list all the blobs in the container
-            prefix: Optional[str]
-            if path.parts:
-                prefix = str(path)
-            else:
-                prefix = None
-
-            blobs = self.container_client.list_blobs(name_starts_with=prefix)
-
-            downloaded_metadata = []
-
-            for blob in blobs:
-                blob_path = Path(blob.name)
-                if blob_path.suffix != ".package":
-                    log.debug("Skipping non-metadata file: %s", blob.name)
-                    continue
-
-                # Found a metadata file. Download it to the temp directory
-                metadata_path = temp_root / blob_path.name
-                metadata_blob_client = self.container_client.get_blob_client(blob.name)
-                with open(metadata_path, "wb") as g:
-                    stream = metadata_blob_client.download_blob()
-                    g.write(stream.readall())
-                log.debug("Downloaded metadata %s to %s", blob_path, metadata_path)
-
-                downloaded_metadata.append(metadata_path)
-
-            # Now iterate over the downloaded metadata files and extract them
-            extract_roots = []
-
-            for index, metadata_path in enumerate(downloaded_metadata):
-                extract_root = package_dir / f"metadata-{index}"
-                extract_root.mkdir(parents=True, exist_ok=True)
-                log.debug("Extracting metadata %s to %s", metadata_path, extract_root)
-                extract_repodata = extract_root / "repodata"
-
-                with tarfile.open(metadata_path, "r:gz") as tar:
-                    tar.extractall(path=extract_root)
-                    if not extract_repodata.exists():
-                        raise FileNotFoundError("Failed to extract metadata")
-
-                extract_roots.append(extract_root)
-                log.debug("Extracted metadata %s to %s", metadata_path, extract_root)
+            # Download all the metadata files for the path and extract each one
+            # into its own directory as it arrives.
+            extractions: List[Tuple[str, Path]] = [
+                (name, package_dir / f"metadata-{index}")
+                for index, name in enumerate(sorted(metadata_names))
+            ]
+            concurrent_map(
+                lambda extraction: self._extract_metadata(*extraction),
+                extractions,
+                _merge_share(MAX_CONCURRENCY),
+            )
+            extract_roots = [extract_root for _, extract_root in extractions]
 
             # Now that we've extracted all the metadata's let's merge them together.
             # Construct the command to merge the metadata
@@ -294,52 +565,70 @@ class AzureBaseRepository(BaseRepository):
             log.info("Merged metadata for path %s to %s", path, output_repodata)
 
             # Work out the set of remote metadata files that already exist.
-            target_repodata = path / "repodata"
-
-            existing_remote_metadata = set(
-                Path(blob.name).name
-                for blob in self.container_client.list_blobs(
-                    name_starts_with=str(target_repodata)
-                )
-            )
+            existing_remote_metadata = set(existing_repodata)
             log.debug(
                 "There are %d existing metadata files", len(existing_remote_metadata)
             )
 
-            new_metadata = set(metadata.name for metadata in output_repodata.iterdir())
+            # Walk the generated metadata once, keeping the names and paths.
+            with os.scandir(output_repodata) as it:
+                entries = [(entry.name, entry.path) for entry in it]
+
+            new_metadata = {name for name, _ in entries}
 
             to_delete = existing_remote_metadata - new_metadata
             log.debug("There are %d metadata files to delete", len(to_delete))
             log.debug("Files to delete: %s", to_delete)
 
-            # Upload all the metadata files to the container
-            for metadata_file in output_repodata.iterdir():
-                target_path = path / "repodata" / metadata_file.name
-
-                metadata_blob_client = self.container_client.get_blob_client(
-                    str(target_path)
-                )
-                with open(metadata_file, "rb") as g:
-                    metadata_blob_client.upload_blob(g, overwrite=True)
-                log.debug("Uploaded metadata %s to %s", metadata_file, target_path)
-
-            # Delete any metadata files that are no longer needed
-            for delete_file in to_delete:
-                delete_path = path / "repodata" / delete_file
-                delete_client = self.container_client.get_blob_client(str(delete_path))
-                delete_client.delete_blob()
-                log.debug("Deleted obsolete metadata %s", delete_path)
+            # Upload all the metadata files to the container. repomd.xml
+            # refers to the other files, so upload it once they're all present.
+            uploads = [
+                (metadata_file, str(path / "repodata" / name))
+                for name, metadata_file in entries
+                if name != "repomd.xml"
+            ]
+            concurrent_map(
+                lambda upload: self._upload_file(*upload),
+                uploads,
+                _merge_share(REPODATA_UPLOAD_CONCURRENCY),
+            )
+            repomd_metadata = (
+                {FINGERPRINT_KEY: fingerprint} if fingerprint is not None else None
+            )
+            for name, metadata_file in entries:
+                if name == "repomd.xml":
+                    self._upload_file(
+                        metadata_file,
+                        str(path / "repodata" / name),
+                        metadata=repomd_metadata,
+                    )
+
+            # Delete any metadata files that are no longer needed, in as few
+            # batch requests as possible.
+            delete_paths = sorted(
+                str(path / "repodata" / delete_file) for delete_file in to_delete
+            )
+            for batch in chunks(delete_paths, MAX_BATCH_SIZE):
+                self.container_client.delete_blobs(*batch)
+                log.debug("Deleted obsolete metadata %s", batch)
 
 
 class AzureDistributionRepository(AzureBaseRepository):
     """A class to manage an RPM repository organised by distribution in ABS."""
 
     def __init__(
-        self, container_client: ContainerClient, upload_directory: str = "upload"
+        self,
+        container_client: ContainerClient,
+        upload_directory: str = "upload",
+        root: Path = Path("."),
     ):
-        """Create an AzureDistributionRepository object."""
+        """Create an AzureDistributionRepository object.
+
+        The repository lives under `root` in the container; by default, that's
+        the whole container.
+        """
         organiser = AzureDistributionOrganiser(
-            container_client, Path("."), upload_directory=upload_directory
+            container_client, root, upload_directory=upload_directory
         )
         super().__init__(
             container_client,
@@ -351,11 +640,18 @@ class AzureFlatRepository(AzureBaseRepository):
     """A class to manage a flat RPM repository in ABS."""
 
     def __init__(
-        self, container_client: ContainerClient, upload_directory: str = "upload"
+        self,
+        container_client: ContainerClient,
+        upload_directory: str = "upload",
+        root: Path = Path("."),
     ):
-        """Create an AzureFlatRepository object."""
+        """Create an AzureFlatRepository object.
+
+        The repository lives under `root` in the container; by default, that's
+        the whole container.
+        """
         organiser = AzureFlatOrganiser(
-            container_client, Path("."), upload_directory=upload_directory
+            container_client, root, upload_directory=upload_directory
         )
         super().__init__(
             container_client,
@@ -2,20 +2,69 @@
 # Licensed under the MIT License.
 """Classes to extract RPM package information for a given package file."""
 
+import functools
+import io
 import logging
+import os
 import re
-import shutil
+import struct
 import tempfile
+import time
 from collections import namedtuple
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Iterable, Optional
 
 import rpmfile
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
 from azure.storage.blob import BlobClient, ContainerClient
 
+from rpm_package_function.utils import concurrent_map, copy_file, move_file
+
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# The Fedora versioning guidelines say to use the %autorelease macro
+# to control the release number. This macro is the number of
+# builds since the last version change, suffixed with the
+# distribution of the build (e.g. 1%{?dist}, 2%{?dist}, etc.).
+# Since this is a `should` and not a `must`, we can't rely on it,
+# but if the version number matches the format, let's use it.
+#
+# AzureLinux doesn't use %autorelease but does use the same N%{?dist}
+# scheme.
+#
+# Technically there can also be a `minor_bump` in the release number,
+# which is a number after a dot. We should also handle that.
+#
+# The pattern matches the raw header bytes, before they are decoded.
+_RELEASE_DIST_RE = re.compile(rb"^\d+\.([^.]+)")
+
+# Number of parallel range requests used to download a package.
+DOWNLOAD_CONCURRENCY = 8
+
+# Number of packages RemoteRpmPackage.prefetch_many works on at once. It's used to
+# read the headers of uploads, which are small, so many can be read at once.
+HEADER_PREFETCH_CONCURRENCY = 32
+
+# Number of bytes fetched from the start of a remote package to read its
+# headers. The lead, signature and header of most packages fit in this.
+HEADER_FETCH_SIZE = 64 * 1024
+
+# An RPM starts with a fixed size lead, followed by the signature and main
+# headers. Each header starts with an intro giving the sizes of its index and
+# data store.
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8"
+RPM_HEADER_INTRO = struct.Struct("!3sB4sii")
+RPM_INDEX_ENTRY_SIZE = 16
+
+# Number of remote packages whose information is remembered, keyed on ETag.
+INFO_CACHE_SIZE = 4096
+
+# Bounds, in seconds, of the delay between checks on a pending blob copy.
+COPY_POLL_INITIAL = 0.1
+COPY_POLL_MAX = 5.0
 
 PackageInfo = namedtuple("PackageInfo", ["name", "version", "dist", "arch", "release"])
 
@@ -49,7 +98,12 @@ class BaseRpmPackage:
 
     def _package_info(self, path: Path) -> PackageInfo:
         """Extract the package information from the RPM file."""
-        with rpmfile.open(str(path)) as rpm:
+        with open(path, "rb") as f:
+            return self._package_info_from_fileobj(f)
+
+    def _package_info_from_fileobj(self, fileobj: BinaryIO) -> PackageInfo:
+        """Extract the package information from an RPM file object."""
+        with rpmfile.open(fileobj=fileobj) as rpm:
             # Load data from the RPM headers. The data is binary, so we
             # need to decode it.
             headers = rpm.headers
@@ -59,27 +113,14 @@ class BaseRpmPackage:
             version = headers["version"].decode("utf-8")
 
             # Extract the release number and architecture if they exist.
-            release = headers.get("release", b"").decode("utf-8")
+            raw_release = headers.get("release", b"")
+            release = raw_release.decode("utf-8")
             arch = headers.get("arch", b"").decode("utf-8")
 
-            # The Fedora versioning guidelines say to use the %autorelease macro
-            # to control the release number. This macro is the number of
-            # builds since the last version change, suffixed with the
-            # distribution of the build (e.g. 1%{?dist}, 2%{?dist}, etc.).
-            # Since this is a `should` and not a `must`, we can't rely on it,
-            # but if the version number matches the format, let's use it.
-            #
-            # AzureLinux doesn't use %autorelease but does use the same N%{?dist}
-            # scheme.
-            #
-            # Technically there can also be a `minor_bump` in the release number,
-            # which is a number after a dot. We should also handle that.
-            pattern = r"^\d+\.([^\.]+)"
-
             dist: Optional[str]
 
-            if m := re.match(pattern, release):
-                dist = m.group(1)
+            if m := _RELEASE_DIST_RE.match(raw_release):
+                dist = m.group(1).decode("utf-8")
             else:
                 dist = None
 
@@ -96,33 +137,37 @@ class LocalRpmPackage(BaseRpmPackage):
     def __init__(self, path: Path):
         """Create a new LocalRpmPackage object."""
         self.path = path
+        self._info: Optional[PackageInfo] = None
+
+    def info(self) -> PackageInfo:
+        """Get all of the package information.
 
-        info = self._package_info(path)
-        self._name = info.name
-        self._version = info.version
-        self._dist = info.dist
-        self._arch = info.arch
-        self._release = info.release
+        The headers are only parsed when the information is first needed, so
+        packages that are just being copied around don't pay for it.
+        """
+        if self._info is None:
+            self._info = self._package_info(self.path)
+        return self._info
 
     def name(self) -> str:
         """Get the name of the package."""
-        return self._name
+        return self.info().name
 
     def version(self) -> str:
         """Get the version of the package."""
-        return self._version
+        return self.info().version
 
     def dist(self) -> Optional[str]:
         """Get the distribution of the package."""
-        return self._dist
+        return self.info().dist
 
     def arch(self) -> str:
         """Get the architecture of the package."""
-        return self._arch
+        return self.info().arch
 
     def release(self) -> str:
         """Get the release of the package."""
-        return self._release
+        return self.info().release
 
     def package_filename(self) -> str:
         """Get the filename of the package."""
@@ -147,11 +192,23 @@ class LocalRpmPackage(BaseRpmPackage):
 class RemoteRpmPackage(BaseRpmPackage):
     """A class to extract RPM package information from a remote package file."""
 
-    def __init__(self, path: Path, container_client: ContainerClient):
-        """Create a new RemoteRpmPackage object."""
+    def __init__(
+        self,
+        path: Path,
+        container_client: ContainerClient,
+        etag: Optional[str] = None,
+    ):
+        """Create a new RemoteRpmPackage object.
+
+        If the blob's ETag is already known (e.g. from a listing), passing it
+        saves a request when looking up the package information.
+        """
         self.path = path
         self.container_client = container_client
+        self.etag = etag
         self.local_package: Optional[LocalRpmPackage] = None
+        self._info: Optional[PackageInfo] = None
+        self._blob_client: Optional[BlobClient] = None
 
     def __repr__(self):
         """Return a string representation of the package."""
@@ -164,71 +221,244 @@ class RemoteRpmPackage(BaseRpmPackage):
     def _get_package(self) -> LocalRpmPackage:
         """Download the package to a temporary file."""
         if self.local_package is None:
-            # Need to download the package
-            with tempfile.NamedTemporaryFile(delete=False) as f:
-                temp_filename = f.name
-
-            blob_client = self.blob_client()
-
-            with open(temp_filename, "wb") as f:
-                stream = blob_client.download_blob()
-                f.write(stream.readall())
+            # Need to download the package. mkstemp creates the file privately
+            # and returns it already open, so there's no need to reopen it.
+            fd, temp_filename = tempfile.mkstemp(suffix=".rpm")
+
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    self._download(f)
+            except BaseException:
+                # Don't leave a partial download behind
+                os.unlink(temp_filename)
+                raise
 
             self.local_package = LocalRpmPackage(Path(temp_filename))
             log.debug("Package downloaded to %s", temp_filename)
 
         return self.local_package
 
+    def _download(self, f: BinaryIO) -> None:
+        """Download the package into an open file."""
+        # Stream the package to disk as it arrives rather than holding the
+        # whole package in memory, fetching chunks of it in parallel.
+        stream = self.blob_client().download_blob(max_concurrency=DOWNLOAD_CONCURRENCY)
+        stream.readinto(f)
+
+    def _get_info(self) -> PackageInfo:
+        """Get the package information, reading only the package headers."""
+        if self._info is not None:
+            return self._info
+
+        # Parse the headers of a downloaded package locally
+        if self.local_package is not None:
+            self._info = self.local_package.info()
+            return self._info
+
+        # The same blob contents have the same ETag, so the information can be
+        # shared with any other object (or invocation) that has already read it.
+        if self.etag is None:
+            self.etag = self.blob_client().get_blob_properties().etag
+
+        self._info = _cached_info(self.container_client, str(self.path), self.etag)
+        return self._info
+
+    def _read_info(self) -> PackageInfo:
+        """Read the package information from the package headers."""
+        # The headers are at the start of the package, so parse them from
+        # ranged downloads rather than fetching the whole package. Most headers
+        # fit in the first request; larger ones need a second to fetch the rest.
+        blob_client = self.blob_client()
+
+        # Only read the version of the package the ETag identifies, as that's
+        # what the information will be cached against.
+        match_condition = (
+            MatchConditions.IfNotModified if self.etag is not None else None
+        )
+
+        stream = blob_client.download_blob(
+            offset=0,
+            length=HEADER_FETCH_SIZE,
+            etag=self.etag,
+            match_condition=match_condition,
+        )
+        data = stream.readall()
+
+        # The downloader's size is that of the range downloaded; the size of the
+        # whole package is at the end of the content range ("bytes 0-N/size").
+        size = int(str(stream.properties.content_range).rpartition("/")[2])
+
+        while len(data) < (end := min(_header_end(data), size)):
+            log.debug("Fetching %d more bytes of %s headers", end - len(data), self)
+            stream = blob_client.download_blob(
+                offset=len(data),
+                length=end - len(data),
+                etag=self.etag,
+                match_condition=match_condition,
+            )
+            data += stream.readall()
+
+        return self._package_info_from_fileobj(io.BytesIO(data))
+
     def blob_client(self) -> BlobClient:
         """Get the BlobClient for the package."""
-        return self.container_client.get_blob_client(str(self.path))
+        if self._blob_client is None:
+            self._blob_client = self.container_client.get_blob_client(str(self.path))
+        return self._blob_client
 
     def name(self) -> str:
         """Get the name of the package."""
-        return self._get_package().name()
+        return self._get_info().name
 
     def version(self) -> str:
         """Get the version of the package."""
-        return self._get_package().version()
+        return self._get_info().version
 
     def dist(self) -> Optional[str]:
         """Get the distribution of the package."""
-        return self._get_package().dist()
+        return self._get_info().dist
 
     def arch(self) -> str:
         """Get the architecture of the package."""
-        return self._get_package().arch()
+        return self._get_info().arch
 
     def release(self) -> str:
         """Get the release of the package."""
-        return self._get_package().release()
+        return self._get_info().release
 
     def package_filename(self) -> str:
         """Get the filename of the package."""
         return self.path.name
 
-    def move(self, new_path_str: str) -> None:
-        """Rename the package in the container."""
+    def move(self, new_path_str: str, check_exists: bool = True) -> None:
+        """Rename the package in the container.
+
+        The copy is only made if the new blob doesn't exist, so the separate
+        existence check can be skipped with `check_exists=False` to save a
+        request; either way FileExistsError is raised if it exists.
+        """
         old_path = self.path
         blob_client = self.blob_client()
         new_blob_client = self.container_client.get_blob_client(new_path_str)
 
         # Check if the new blob already exists
-        if new_blob_client.exists():
+        if check_exists and new_blob_client.exists():
             raise FileExistsError(f"{new_path_str} already exists")
 
-        # Copy the blob to the new location
-        new_blob_client.start_copy_from_url(blob_client.url)
+        # Copy the blob to the new location. Copies within an account usually
+        # complete straight away, but may be left pending by the service.
+        try:
+            copy = new_blob_client.start_copy_from_url(
+                blob_client.url, match_condition=MatchConditions.IfMissing
+            )
+        except (ResourceExistsError, ResourceModifiedError) as e:
+            raise FileExistsError(f"{new_path_str} already exists") from e
+
+        status: Optional[str] = str(copy["copy_status"])
+        delay = COPY_POLL_INITIAL
+
+        while status == "pending":
+            time.sleep(delay)
+            delay = min(delay * 2, COPY_POLL_MAX)
+            status = new_blob_client.get_blob_properties().copy.status
+
+        # Only delete the old blob once it is safely copied
+        if status != "success":
+            raise RuntimeError(f"Failed to copy {old_path} to {new_path_str}")
 
-        # Delete the old blob
         blob_client.delete_blob()
 
-        # Update the path
+        # Update the path. The copy has its own ETag.
         self.path = Path(new_path_str)
+        self.etag = None
+        self._blob_client = new_blob_client
         log.info("Package moved from %s to %s", old_path, new_path_str)
 
+    def prefetch(self, headers_only: bool = False) -> None:
+        """Download the package, or just its headers, ahead of it being needed."""
+        if headers_only:
+            self._get_info()
+        else:
+            self._get_package()
+
+    @classmethod
+    def prefetch_many(
+        cls, packages: Iterable["RemoteRpmPackage"], headers_only: bool = False
+    ) -> None:
+        """Download several packages concurrently ahead of them being needed.
+
+        This is best-effort: a package that can't be prefetched is logged and
+        left to fail when it is actually used, without affecting the others.
+        """
+
+        def prefetch(package: "RemoteRpmPackage") -> None:
+            try:
+                package.prefetch(headers_only)
+            except Exception as e:  # pylint: disable=broad-except
+                log.warning("Failed to prefetch %s: %s", package, e)
+
+        concurrent_map(prefetch, packages, HEADER_PREFETCH_CONCURRENCY)
+
+    def discard_local(self) -> None:
+        """Delete the local copy of the package, if it has been downloaded."""
+        if self.local_package is not None:
+            self.local_package.path.unlink(missing_ok=True)
+            self.local_package = None
+
+    def move_local(self, local_path: Path) -> None:
+        """Move the package to a local file.
+
+        A package that has already been downloaded is moved rather than copied;
+        otherwise it is downloaded straight to `local_path`.
+        """
+        if self.local_package is not None:
+            move_file(self.local_package.path, local_path)
+            self.local_package = None
+        else:
+            with open(local_path, "wb") as f:
+                self._download(f)
+        log.debug("Package moved to %s", local_path)
+
     def copy_local(self, local_path: Path) -> None:
         """Copy the package to a local file."""
         package = self._get_package()
-        shutil.copy(package.path, local_path)
+        copy_file(package.path, local_path)
         log.debug("Package copied to %s", local_path)
+
+
+def _header_end(data: bytes) -> int:
+    """Work out where the headers of an RPM end, from the start of the RPM.
+
+    If `data` doesn't reach far enough to tell, returns the length needed to
+    get further; calling this again with more data gives a better answer.
+    """
+    offset = RPM_LEAD_SIZE
+
+    for is_signature in (True, False):
+        if len(data) < offset + RPM_HEADER_INTRO.size:
+            return offset + RPM_HEADER_INTRO.size
+
+        magic, _, _, entries, store_size = RPM_HEADER_INTRO.unpack_from(data, offset)
+        if magic != RPM_HEADER_MAGIC:
+            # Not an RPM header, so leave it to rpmfile to report
+            return len(data)
+
+        offset += RPM_HEADER_INTRO.size + entries * RPM_INDEX_ENTRY_SIZE + store_size
+
+        # The signature header is padded to a multiple of 8 bytes.
+        if is_signature:
+            offset += -offset % 8
+
+    return offset
+
+
+@functools.lru_cache(maxsize=INFO_CACHE_SIZE)
+def _cached_info(
+    container_client: ContainerClient, blob_name: str, etag: str
+) -> PackageInfo:
+    """Read the information for a version of a remote package.
+
+    The ETag identifies the version of the blob, so it is part of the cache key
+    even though it is not used to read the package.
+    """
+    return RemoteRpmPackage(Path(blob_name), container_client, etag)._read_info()
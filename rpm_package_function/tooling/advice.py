@@ -2,17 +2,8 @@
 # Licensed under the MIT License.
 """Functions for displaying advice after creating a repository"""
 
-
-def advice_distribution_repo(
-    upload_directory: str,
-    package_container: str,
-    storage_account: str,
-    function_app_name: str,
-    base_url: str,
-):
-    """Print advice for a distribution repository."""
-    print(
-        f"""The repository has been created!
+# The advice shared by all repository types.
+_COMMON_TEMPLATE = """The repository has been created!
 Upload packages to the '{upload_directory}/' directory in the
 '{package_container}' container in the '{storage_account}' storage account.
 The function app '{function_app_name}' will be triggered by new packages
@@ -22,7 +13,11 @@ To download packages:
   - Install `dnf-plugin-azure-auth`.
     - Install the plugin from https://github.com/microsoft/dnf-plugin-azure-auth
 
-  - Create a repository file `/etc/yum.repos.d/{storage_account}.repo` with the following content
+"""
+
+_DISTRIBUTION_TEMPLATE = (
+    _COMMON_TEMPLATE
+    + """  - Create a repository file `/etc/yum.repos.d/{storage_account}.repo` with the following content
     for each distribution you want to support:
 
 [{storage_account}`dist`]
@@ -66,29 +61,11 @@ skip_if_unavailable=1
     Multiple entries can exist in `azure_auth.conf`.
 
   - Now, use yum/dnf as normal!"""
-    )
-
-
-def advice_flat_repo(
-    upload_directory: str,
-    package_container: str,
-    storage_account: str,
-    function_app_name: str,
-    base_url: str,
-):
-    """Print advice for a flat repository."""
-    print(
-        f"""The repository has been created!
-Upload packages to the '{upload_directory}/' directory in the
-'{package_container}' container in the '{storage_account}' storage account.
-The function app '{function_app_name}' will be triggered by new packages
-in that container and regenerate the repository.
+)
 
-To download packages:
-  - Install `dnf-plugin-azure-auth`.
-    - Install the plugin from https://github.com/microsoft/dnf-plugin-azure-auth
-
-  - Create a repository file `/etc/yum.repos.d/{storage_account}.repo` with the following content:
+_FLAT_TEMPLATE = (
+    _COMMON_TEMPLATE
+    + """  - Create a repository file `/etc/yum.repos.d/{storage_account}.repo` with the following content:
 
 [{storage_account}]
 name={storage_account}
@@ -102,4 +79,26 @@ skip_if_unavailable=1
 [{storage_account}]
 
   - Now, use yum/dnf as normal!"""
-    )
+)
+
+
+def advice_distribution_repo(
+    upload_directory: str,
+    package_container: str,
+    storage_account: str,
+    function_app_name: str,
+    base_url: str,
+):
+    """Print advice for a distribution repository."""
+    print(_DISTRIBUTION_TEMPLATE.format_map(locals()))
+
+
+def advice_flat_repo(
+    upload_directory: str,
+    package_container: str,
+    storage_account: str,
+    function_app_name: str,
+    base_url: str,
+):
+    """Print advice for a flat repository."""
+    print(_FLAT_TEMPLATE.format_map(locals()))
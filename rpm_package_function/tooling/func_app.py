@@ -10,12 +10,23 @@ from pathlib import Path
 from subprocess import CalledProcessError
 from typing import Any, Dict
 
-from rpm_package_function.tooling.azcmd import AzCmdJson, AzCmdNone
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobClient
+
+from rpm_package_function.tooling.azcmd import AzCmdJson
 from rpm_package_function.tooling.bicep_deployment import BicepDeployment
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# Bounds, in seconds, of the delay between checks for the event trigger.
+TRIGGER_POLL_INITIAL = 0.5
+TRIGGER_POLL_MAX = 30.0
+
+# Block size and number of parallel block uploads for the function app package.
+UPLOAD_BLOCK_SIZE = 8 * 1024 * 1024
+UPLOAD_BLOCK_CONCURRENCY = 16
+
 
 class FuncApp:
     """Basic class for managing function apps."""
@@ -39,27 +50,30 @@ class FuncApp:
                 "-g",
                 self.resource_group,
                 "--query",
-                "[].name",
+                "[?contains(name, 'eventGridTrigger')].name",
             ]
         )
         log.info("Awaiting event trigger on function app %s", self.name)
 
+        # Check quickly at first, backing off if the function app is slow to
+        # come up.
+        delay = TRIGGER_POLL_INITIAL
+
         while True:
             try:
+                # The query filters the functions down to the trigger
                 functions = cmd.run_expect_list()
-                log.info("App functions (%s): %s", self.name, functions)
-
-                for function in functions:
-                    if "eventGridTrigger" in function:
-                        log.info("Found Event Grid trigger: %s", function)
-                        return
+                if functions:
+                    log.info("Found Event Grid trigger: %s", functions[0])
+                    return
 
             except json.JSONDecodeError as e:
                 log.warning("Error decoding JSON: %s", e)
             except CalledProcessError as e:
                 log.debug("Error running command: %s", e)
 
-            time.sleep(5)
+            time.sleep(delay)
+            delay = min(delay * 1.5, TRIGGER_POLL_MAX)
 
     def __enter__(self):
         """Return the object for use in a context manager."""
@@ -92,11 +106,11 @@ class FuncAppBundle(FuncApp):
         cwd = Path.cwd()
 
         # Pack the application using the core-tools tooling
-        # Should generate a file called function_app.zip
+        # Should generate a file called function_app.zip. The container doesn't
+        # need a terminal, so this also works when run non-interactively.
         cmd = [
             "docker",
             "run",
-            "-it",
             "--rm",
             "-v",
             "/var/run/docker.sock:/var/run/docker.sock",
@@ -115,26 +129,41 @@ class FuncAppBundle(FuncApp):
     def deploy(self) -> None:
         """Deploy the function application."""
         log.info("Copying function app code to %s", self.python_container)
-        cmd = AzCmdNone(
+
+        # Get the account's blob endpoint, which depends on the cloud it's in.
+        account_url: str = AzCmdJson(
             [
                 "az",
                 "storage",
-                "blob",
-                "upload",
-                "--auth-mode",
-                "login",
-                "--account-name",
-                self.storage_account,
-                "--container-name",
-                self.python_container,
-                "--file",
-                str(self.output_path),
+                "account",
+                "show",
                 "--name",
-                str(self.output_path),
-                "--overwrite",
+                self.storage_account,
+                "--resource-group",
+                self.resource_group,
+                "--query",
+                "primaryEndpoints.blob",
             ]
+        ).run()
+
+        # Upload in-process rather than through the az CLI. The credential
+        # picks up the az CLI login, as `--auth-mode login` did.
+        blob_client = BlobClient(
+            account_url=account_url,
+            container_name=self.python_container,
+            blob_name=str(self.output_path),
+            credential=DefaultAzureCredential(),
+            max_block_size=UPLOAD_BLOCK_SIZE,
         )
-        cmd.run()
+        with blob_client, open(self.output_path, "rb") as f:
+            # Each block is checked with an MD5 hash as it's uploaded.
+            blob_client.upload_blob(
+                f,
+                length=self.output_path.stat().st_size,
+                overwrite=True,
+                max_concurrency=UPLOAD_BLOCK_CONCURRENCY,
+                validate_content=True,
+            )
 
         # Create the function app
         func_app_params = {
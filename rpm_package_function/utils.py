@@ -3,16 +3,127 @@
 """Utility functions."""
 
 import contextlib
+import errno
+import logging
 import os
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Sequence, TypeVar
+
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# The number of blobs to request per page when listing a container.
+LIST_PAGE_SIZE = 5000
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 @contextlib.contextmanager
 def temporary_filename():
     """Create a temporary file and return the filename."""
+    fd, temporary_name = tempfile.mkstemp()
+    os.close(fd)
     try:
-        with tempfile.NamedTemporaryFile(delete=False) as f:
-            temporary_name = f.name
         yield temporary_name
     finally:
         os.unlink(temporary_name)
+
+
+def concurrent_map(
+    func: Callable[[T], R], items: Iterable[T], max_workers: int
+) -> List[R]:
+    """Run a function over items concurrently and return the results in order.
+
+    Every item is processed even if some of them fail; once all of the work has
+    finished, the first failure is re-raised.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+
+    results: List[R] = []
+    errors: List[BaseException] = []
+
+    for future in futures:
+        error = future.exception()
+        if error is not None:
+            log.error("Concurrent task failed: %s", error)
+            errors.append(error)
+        else:
+            results.append(future.result())
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+def copy_file(source: Path, destination: Path) -> None:
+    """Copy a file's contents within the kernel where possible.
+
+    copy_file_range lets filesystems that support it (e.g. XFS, btrfs) share
+    the data rather than copy it. Where it isn't available or supported, fall
+    back to shutil.copyfile, which uses sendfile on Linux.
+    """
+    if hasattr(os, "copy_file_range"):
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                log.debug("copy_file_range unavailable: %s", e)
+            else:
+                if remaining == 0:
+                    return
+
+    shutil.copyfile(source, destination)
+
+
+def move_file(source: Path, destination: Path) -> None:
+    """Move a file, copying it with copy_file if it's on another filesystem."""
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(source, destination)
+        os.unlink(source)
+
+
+def create_transport(pool_size: int) -> RequestsTransport:
+    """Create an HTTP transport that keeps up to `pool_size` connections open.
+
+    The requests default is 10 connections; clients used from many threads at
+    once need more, or connections get discarded and re-established.
+    """
+    session = requests.Session()
+
+    # Retries are left to the Azure SDK's retry policy, as in its own sessions.
+    adapter = HTTPAdapter(
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=False, redirect=False, raise_on_status=False),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return RequestsTransport(session=session)
+
+
+def chunks(items: Sequence[T], size: int) -> Iterator[Sequence[T]]:
+    """Split a sequence into consecutive chunks of at most `size` items."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
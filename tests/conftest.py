@@ -3,17 +3,27 @@
 """Fixtures for the RPM package function tests."""
 
 
+import hashlib
 import logging
+import os
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, Generator, List
 
 import pytest
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import ContainerClient
+
+from rpm_package_function.utils import copy_file, create_transport
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# Number of connections the live tests' client keeps open for reuse.
+CONNECTION_POOL_SIZE = 64
+
 
 def create_rpm_in_dir(directory: Path, name: str, version: str, release: str) -> Path:
     """Create a test RPM package in a directory."""
@@ -44,31 +54,60 @@ def create_rpm_in_dir(directory: Path, name: str, version: str, release: str) ->
     return next(rpm_packages)
 
 
-@pytest.fixture(name="rpm_packages", scope="function")
-def fixture_rpm_packages(request) -> Generator[List[Path], None, None]:
-    """Create a test RPM package."""
-    # Unpack the parameters
-    config: List[Dict[str, Any]] = request.param
+def cached_rpm(cache_dir: Path, name: str, version: str, release: str) -> Path:
+    """Get a test RPM package from the cache, creating it if needed.
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        packages = []
-        for package_config in config:
-            name = package_config["name"]
-            version = package_config["version"]
-            release = package_config["release"]
+    Packages are keyed on their specification, so tests asking for the same
+    package share a single build.
+    """
+    spec = {"name": name, "version": version, "release": release}
+    key = hashlib.sha1(repr(sorted(spec.items())).encode()).hexdigest()[:12]
 
-            temp_path = Path(temp_dir) / f"{name}-{version}-{release}"
-            temp_path.mkdir()
-            package = create_rpm_in_dir(temp_path, name, version, release)
-            packages.append(package)
+    package_dir = cache_dir / f"{name}-{version}-{release}-{key}"
+    if package_dir.is_dir():
+        return next(package_dir.glob("*.rpm"))
 
-        yield packages
+    # Build somewhere else first, so that a failed build isn't cached.
+    build_dir = Path(tempfile.mkdtemp(dir=cache_dir))
+    package = create_rpm_in_dir(build_dir, name, version, release)
+    build_dir.rename(package_dir)
 
-    # Upon return everything will be deleted in the temporary directory
+    return package_dir / package.name
+
+
+@pytest.fixture(name="rpm_cache", scope="session")
+def fixture_rpm_cache(tmp_path_factory) -> Path:
+    """Get the directory test RPM packages are cached in for the session."""
+    return tmp_path_factory.mktemp("rpm_packages")
+
+
+@pytest.fixture(name="rpm_packages", scope="session")
+def fixture_rpm_packages(request, rpm_cache: Path) -> List[Path]:
+    """Get test RPM packages.
+
+    The packages are shared with other tests, so must not be modified.
+    """
+    # Unpack the parameters
+    config: List[Dict[str, Any]] = request.param
+
+    args = [
+        (
+            rpm_cache,
+            package_config["name"],
+            package_config["version"],
+            package_config["release"],
+        )
+        for package_config in config
+    ]
+
+    # Each package is built in its own directory, so the (slow to start)
+    # fpm processes can all run at once.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(lambda a: cached_rpm(*a), args))
 
 
 @pytest.fixture(name="repository", scope="function")
-def fixture_repository(request) -> Generator[Path, None, None]:
+def fixture_repository(request, rpm_cache: Path) -> Generator[Path, None, None]:
     """Create a test repository."""
     # Unpack the parameters
 
@@ -86,8 +125,36 @@ def fixture_repository(request) -> Generator[Path, None, None]:
             name = upload_package["name"]
             version = upload_package["version"]
             release = upload_package["release"]
-            create_rpm_in_dir(upload_dir, name, version, release)
+            package = cached_rpm(rpm_cache, name, version, release)
+            copy_file(package, upload_dir / package.name)
 
         yield root
 
     # Upon return everything will be deleted in the temporary directory
+
+
+@pytest.fixture(name="container_client", scope="session")
+def fixture_container_client() -> Generator[ContainerClient, None, None]:
+    """Create a ContainerClient for the live test container.
+
+    The client (and so its credential's token cache and connection pool) is
+    shared by every live test in the session, along with every BlobClient
+    created from it.
+    """
+    credential = DefaultAzureCredential()
+    with ContainerClient.from_container_url(
+        container_url=os.environ["BLOB_CONTAINER_URL"],
+        credential=credential,
+        transport=create_transport(CONNECTION_POOL_SIZE),
+    ) as container_client:
+        yield container_client
+
+
+@pytest.fixture(name="worker_prefix", scope="session")
+def fixture_worker_prefix() -> Path:
+    """Get a container prefix unique to this test worker.
+
+    Live tests work under this prefix, so that tests running in parallel
+    workers (e.g. with pytest-xdist) don't interfere with each other.
+    """
+    return Path(f"test-{os.environ.get('PYTEST_XDIST_WORKER', 'gw0')}")
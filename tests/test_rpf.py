@@ -3,13 +3,16 @@
 """Tests for the RPM package function."""
 
 
+import functools
 import logging
 import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Union
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union, cast
 
 import pytest
-from azure.identity import DefaultAzureCredential
 from azure.storage.blob import ContainerClient
 
 from rpm_package_function import (
@@ -20,7 +23,21 @@ from rpm_package_function import (
     DistributionOrganiser,
     FlatOrganiser,
     LocalRpmPackage,
+    ProcessResult,
+    RemoteRpmPackage,
 )
+from rpm_package_function.repomanager import (
+    FINGERPRINT_KEY,
+    MAX_BATCH_SIZE,
+    METADATA_CHECK_KEY,
+)
+from rpm_package_function.rpmpackage import (
+    HEADER_FETCH_SIZE,
+    RPM_HEADER_INTRO,
+    RPM_LEAD_SIZE,
+    _header_end,
+)
+from rpm_package_function.utils import chunks
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -34,6 +51,15 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 TEST_DIR = Path(__file__).parent
 
+# Number of packages uploaded or cleaned up at once in the live tests.
+LIVE_CONCURRENCY = 16
+
+# Number of blocks of each package uploaded at once in the live tests.
+UPLOAD_BLOCK_CONCURRENCY = 8
+
+# The last modified time of every blob in the offline test containers.
+LAST_MODIFIED = "2024-01-01 00:00:00+00:00"
+
 
 @pytest.mark.parametrize(
     "rpm_packages",
@@ -61,7 +87,7 @@ TEST_DIR = Path(__file__).parent
 def test_various_packages(rpm_packages: List[Path]) -> None:
     """Test that LocalRpmPackage can handle different things being thrown at it."""
     for rpm_package in rpm_packages:
-        LocalRpmPackage(rpm_package)
+        LocalRpmPackage(rpm_package).info()
 
 
 @pytest.mark.parametrize(
@@ -142,57 +168,395 @@ def test_list_packages(repository) -> None:
     assert packages[0].dist() == "cm2"
 
 
+class ListingContainerClient:
+    """A stand-in for a ContainerClient that only supports listing blobs."""
+
+    def __init__(
+        self,
+        names: List[str],
+        metadata: Optional[Dict[str, Dict[str, str]]] = None,
+    ):
+        """Create a container holding blobs with the given names and metadata."""
+        metadata = metadata or {}
+        self.blobs = {
+            name: SimpleNamespace(
+                name=name,
+                etag=f"etag-{index}",
+                last_modified=LAST_MODIFIED,
+                metadata=metadata.get(name),
+            )
+            for index, name in enumerate(names)
+        }
+        self.list_calls: List[Optional[str]] = []
+
+    def list_blobs(self, name_starts_with: Optional[str] = None, **kwargs: Any):
+        """List the blobs, filtering by prefix as the service does."""
+        self.list_calls.append(name_starts_with)
+        return [
+            blob
+            for name, blob in self.blobs.items()
+            if name.startswith(name_starts_with or "")
+        ]
+
+    def walk_blobs(self, name_starts_with: Optional[str] = None, **kwargs: Any):
+        """List the blobs directly under a prefix, leaving out any subdirectories."""
+        prefix = name_starts_with or ""
+        return [
+            blob
+            for name, blob in self.blobs.items()
+            if name.startswith(prefix) and "/" not in name[len(prefix) :]
+        ]
+
+
+def test_azure_list_uploads() -> None:
+    """Test that listing uploads asks the service for just the upload directory."""
+    container_client = ListingContainerClient(
+        [
+            "cm/2/sorted-1.0-1.cm2.x86_64.rpm",
+            "upload/first.rpm",
+            "upload/notes.txt",
+            "upload/second.rpm",
+            "uploads-old/stale.rpm",
+        ]
+    )
+    organiser = AzureDistributionOrganiser(
+        cast(ContainerClient, container_client), Path(".")
+    )
+
+    packages = organiser.list_uploads()
+
+    # A single listing of the upload directory, filtered by the service
+    assert container_client.list_calls == ["upload/"]
+    assert [package.package_filename() for package in packages] == [
+        "first.rpm",
+        "second.rpm",
+    ]
+
+
+def test_process_skips_unchanged_repodata(monkeypatch) -> None:
+    """Test that repository metadata is only merged when package metadata changes."""
+    package_path = "cm/2/first-1.0-1.cm2.x86_64.rpm"
+    metadata_path = "cm/2/first-1.0-1.cm2.x86_64.package"
+    container_client = ListingContainerClient(
+        [package_path, metadata_path, "cm/2/repodata/repomd.xml"],
+        metadata={metadata_path: {METADATA_CHECK_KEY: LAST_MODIFIED}},
+    )
+    repo = AzureDistributionRepository(cast(ContainerClient, container_client))
+
+    # Stand in for merging, recording the fingerprint as the upload would.
+    merged = []
+
+    def merge_metadata(path, metadata_names, existing_repodata, fingerprint=None):
+        merged.append(path)
+        repomd = container_client.blobs[f"{path}/repodata/repomd.xml"]
+        repomd.metadata = {FINGERPRINT_KEY: fingerprint}
+
+    monkeypatch.setattr(repo, "merge_metadata", merge_metadata)
+
+    # The existing repository metadata has no fingerprint, so is merged...
+    assert repo.process(Path(package_path)) == ProcessResult(False, True)
+
+    # ... but the second time round, nothing has changed.
+    assert repo.process(Path(package_path)) == ProcessResult(False, False)
+    assert merged == [Path("cm/2")]
+
+
+def test_process_organises_nested_uploads(monkeypatch) -> None:
+    """Test that an upload in a subdirectory of the upload directory is organised."""
+    package_path = "upload/sub/first-1.0-1.cm2.x86_64.rpm"
+    container_client = ListingContainerClient([package_path])
+    repo = AzureDistributionRepository(cast(ContainerClient, container_client))
+
+    organised = []
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Uploads must not have metadata generated")
+
+    monkeypatch.setattr(repo.organiser, "organise", lambda: organised.append(True))
+    monkeypatch.setattr(repo, "create_metadata", fail)
+    monkeypatch.setattr(repo, "merge_metadata", fail)
+
+    assert repo.process(Path(package_path)) == ProcessResult(False, False)
+    assert organised == [True]
+
+
+def build_rpm_header(entries: List[Tuple[int, int, bytes, int]]) -> bytes:
+    """Build an RPM header from (tag, type, data, count) entries."""
+    index = b""
+    store = b""
+    for tag, tag_type, data, count in entries:
+        index += struct.pack("!iiii", tag, tag_type, len(store), count)
+        store += data
+
+    return (
+        RPM_HEADER_INTRO.pack(b"\x8e\xad\xe8", 1, b"\0" * 4, len(entries), len(store))
+        + index
+        + store
+    )
+
+
+def build_rpm(
+    name: str, version: str, release: str, filelist_size: int = 0
+) -> Tuple[bytes, int]:
+    """Build a minimal RPM in memory, without needing fpm.
+
+    `filelist_size` pads the main header with roughly that many bytes of file
+    names, as packages with many files have. Returns the RPM and the length of
+    its headers.
+    """
+    lead = struct.pack(
+        "!4sBBhh66shh16s", b"\xed\xab\xee\xdb", 3, 0, 0, 1, name.encode(), 1, 5, b""
+    )
+
+    # The signature header is padded to a multiple of 8 bytes.
+    signature = build_rpm_header([(1000, 4, struct.pack("!i", 0), 1)])
+    signature += b"\0" * (-len(signature) % 8)
+
+    # Name, version, release and arch, and optionally some base names.
+    entries = [
+        (1000, 6, f"{name}\0".encode(), 1),
+        (1001, 6, f"{version}\0".encode(), 1),
+        (1002, 6, f"{release}\0".encode(), 1),
+        (1022, 6, b"x86_64\0", 1),
+    ]
+    if filelist_size:
+        filename = b"f" * 63 + b"\0"
+        count = filelist_size // len(filename)
+        entries.append((1117, 8, filename * count, count))
+
+    headers = lead + signature + build_rpm_header(entries)
+
+    # The payload follows the headers, and never needs to be read.
+    return headers + b"\x55" * 100_000, len(headers)
+
+
+class RangedBlobClient:
+    """A stand-in for a BlobClient that only supports ranged downloads."""
+
+    def __init__(self, data: bytes):
+        """Create a blob holding the given data."""
+        self.data = data
+        self.ranges: List[Tuple[int, int]] = []
+        self.etags: List[Optional[str]] = []
+
+    def download_blob(self, offset: int = 0, length: Optional[int] = None, **kwargs):
+        """Download part of the blob, with properties as the SDK sets them."""
+        end = len(self.data) if length is None else min(offset + length, len(self.data))
+        self.ranges.append((offset, end))
+        self.etags.append(kwargs.get("etag"))
+
+        # As in the SDK, the size is that of the range downloaded, and the
+        # content range gives the size of the whole blob.
+        properties = SimpleNamespace(
+            size=end - offset,
+            content_range=f"bytes {offset}-{end - 1}/{len(self.data)}",
+        )
+        return SimpleNamespace(
+            properties=properties, readall=lambda: self.data[offset:end]
+        )
+
+
+def test_header_end() -> None:
+    """Test that the end of the RPM headers is found from their lengths."""
+    rpm, headers_size = build_rpm("test", "1.0", "1.cm2", filelist_size=1000)
+
+    # Without enough data to read a header's sizes, ask for enough to do so.
+    assert _header_end(rpm[:50]) == RPM_LEAD_SIZE + RPM_HEADER_INTRO.size
+
+    # Once the main header's sizes are known, the end is exact.
+    assert _header_end(rpm) == headers_size
+    assert _header_end(rpm[:headers_size]) == headers_size
+
+
+@pytest.mark.parametrize(
+    "filelist_size,requests",
+    [
+        # The headers fit in the first download.
+        (0, 1),
+        # The headers are larger than the first download, so need a second.
+        (200_000, 2),
+    ],
+)
+def test_read_info(filelist_size: int, requests: int) -> None:
+    """Test that a remote package's information is read from ranged downloads."""
+    rpm, headers_size = build_rpm("test", "1.0", "1.cm2", filelist_size=filelist_size)
+    assert (headers_size > HEADER_FETCH_SIZE) == (requests > 1)
+
+    blob_client = RangedBlobClient(rpm)
+    container_client = SimpleNamespace(get_blob_client=lambda name: blob_client)
+    package = RemoteRpmPackage(
+        Path("upload/test.rpm"), cast(ContainerClient, container_client), etag="1"
+    )
+
+    info = package._read_info()  # pylint: disable=protected-access
+
+    assert (info.name, info.version, info.release) == ("test", "1.0", "1.cm2")
+    assert info.dist == "cm2"
+
+    # Only the headers are downloaded, not the payload.
+    assert len(blob_client.ranges) == requests
+    assert blob_client.ranges[-1][1] == max(headers_size, HEADER_FETCH_SIZE)
+
+    # Every download is of the version of the package with the known ETag.
+    assert blob_client.etags == ["1"] * requests
+
+
+class UploadContainerClient(ListingContainerClient):
+    """A stand-in for a ContainerClient holding uploads that can be read."""
+
+    def __init__(self, contents: Dict[str, bytes]):
+        """Create a container holding blobs with the given contents."""
+        super().__init__(list(contents))
+        self.contents = contents
+
+    def get_blob_client(self, name: str) -> RangedBlobClient:
+        """Get a client to download a blob."""
+        return RangedBlobClient(self.contents[name])
+
+
+def test_organise_skips_bad_uploads(monkeypatch) -> None:
+    """Test that an unreadable upload doesn't stop other uploads being organised."""
+    rpm, _ = build_rpm("good", "1.0", "1.cm2")
+    container_client = UploadContainerClient(
+        {"upload/bad.rpm": b"not an rpm", "upload/good.rpm": rpm}
+    )
+    organiser = AzureDistributionOrganiser(
+        cast(ContainerClient, container_client), Path(".")
+    )
+
+    moved = []
+    monkeypatch.setattr(
+        RemoteRpmPackage,
+        "move",
+        lambda package, new_path_str, check_exists=True: moved.append(new_path_str),
+    )
+
+    organiser.organise()
+
+    assert moved == ["cm/2/good-1.0-1.cm2.x86_64.rpm"]
+
+
 def live_clean_package(
-    package: Path,
+    package: LocalRpmPackage,
     organiser: Union[AzureDistributionOrganiser, AzureFlatOrganiser],
     assert_exists: bool = False,
 ) -> None:
     """Clean up an existing package."""
-    # Determine the path of the package
-    sorted_path = organiser.get_path(LocalRpmPackage(package))
-    log.debug("Cleaning up package %s", sorted_path)
+    live_clean_batch([package], organiser, assert_exists=assert_exists)
 
-    # Clean up an existing package
-    sorted_blob = organiser.container_client.get_blob_client(str(sorted_path))
 
-    if assert_exists:
-        # Check that the sorted blob exists before deleting it.
-        assert sorted_blob.exists()
+@functools.lru_cache(maxsize=None)
+def live_package_blobs(
+    package: LocalRpmPackage,
+    organiser: Union[AzureDistributionOrganiser, AzureFlatOrganiser],
+) -> Tuple[str, str]:
+    """Get the blobs a package and its metadata are organised into.
+
+    Packages are cleaned up both before and after each test, so the paths are
+    only worked out once.
+    """
+    sorted_path = organiser.get_path(package)
+    return str(sorted_path), str(sorted_path.with_suffix(".package"))
 
-    if sorted_blob.exists():
-        sorted_blob.delete_blob()
 
-    # Clean the metadata
-    metadata = sorted_path.with_suffix(".package")
-    metadata_blob = organiser.container_client.get_blob_client(str(metadata))
-    if metadata_blob.exists():
-        log.debug("Cleaning up metadata %s", metadata)
-        metadata_blob.delete_blob()
+def live_clean_batch(
+    packages: Sequence[LocalRpmPackage],
+    organiser: Union[AzureDistributionOrganiser, AzureFlatOrganiser],
+    assert_exists: bool = False,
+) -> None:
+    """Clean up existing packages and their metadata in a single batch request.
+
+    Blobs that don't exist are reported as not found rather than failing the
+    batch.
+    """
+    # Determine the paths of the packages and their metadata
+    blobs: List[str] = []
+    for package in packages:
+        blobs.extend(live_package_blobs(package, organiser))
+
+    responses = list(
+        organiser.container_client.delete_blobs(*blobs, raise_on_any_failure=False)
+    )
+    log.debug(
+        "Deleting %s: %s", blobs, [response.status_code for response in responses]
+    )
+
+    if assert_exists:
+        # Check that the sorted blobs existed before they were deleted.
+        assert all(response.status_code == 202 for response in responses[::2])
 
 
 def live_clean_and_upload_package(
-    package: Path,
+    package: LocalRpmPackage,
     organiser: Union[AzureDistributionOrganiser, AzureFlatOrganiser],
-    upload_directory: str = "upload",
 ) -> None:
     """Clean up any existing packages and upload a package to the container."""
     live_clean_package(package, organiser)
+    live_upload_package(package, organiser)
 
+
+def live_upload_package(
+    package: LocalRpmPackage,
+    organiser: Union[AzureDistributionOrganiser, AzureFlatOrganiser],
+) -> None:
+    """Upload a package to the container, replacing any existing upload."""
     # Upload the package to the container in the upload directory
-    upload_path = Path(upload_directory) / package.name
+    upload_path = organiser.upload_directory / package.package_filename()
     upload_client = organiser.container_client.get_blob_client(str(upload_path))
-    with open(package, "rb") as f:
-        upload_client.upload_blob(f, overwrite=True)
-    log.debug("Uploaded package %s to %s", package, upload_path)
+    with open(package.path, "rb") as f:
+        upload_client.upload_blob(
+            f,
+            overwrite=True,
+            length=package.path.stat().st_size,
+            max_concurrency=UPLOAD_BLOCK_CONCURRENCY,
+        )
+    log.debug("Uploaded package %s to %s", package.path, upload_path)
+
+
+def live_clean_and_upload_packages(
+    packages: List[LocalRpmPackage],
+    organiser: Union[AzureDistributionOrganiser, AzureFlatOrganiser],
+) -> None:
+    """Clean up and upload several packages at once."""
+    # Clean up in as few batch requests as possible before uploading.
+    live_clean_packages(packages, organiser)
+
+    with ThreadPoolExecutor(max_workers=LIVE_CONCURRENCY) as executor:
+        list(
+            executor.map(
+                lambda package: live_upload_package(package, organiser),
+                packages,
+            )
+        )
+
+
+def live_clean_packages(
+    packages: List[LocalRpmPackage],
+    organiser: Union[AzureDistributionOrganiser, AzureFlatOrganiser],
+    assert_exists: bool = False,
+) -> None:
+    """Clean up several packages at once."""
+    # Each package has two blobs to delete, which are kept in the same batch.
+    batches = list(chunks(packages, MAX_BATCH_SIZE // 2))
+    with ThreadPoolExecutor(max_workers=LIVE_CONCURRENCY) as executor:
+        list(
+            executor.map(
+                lambda batch: live_clean_batch(
+                    batch, organiser, assert_exists=assert_exists
+                ),
+                batches,
+            )
+        )
 
 
 def live_clean_metadata(container_client: ContainerClient, metadata: Path) -> None:
     """Clean up any existing metadata."""
-    blobs = container_client.list_blobs(name_starts_with=str(metadata))
-    for blob in blobs:
-        blob_client = container_client.get_blob_client(blob.name)
-        log.debug("Deleting metadata file: %s", blob.name)
-        blob_client.delete_blob()
+    names = list(container_client.list_blob_names(name_starts_with=str(metadata)))
+    log.debug("Deleting metadata files: %s", names)
+
+    # Delete the files in as few requests as possible
+    for batch in chunks(names, MAX_BATCH_SIZE):
+        container_client.delete_blobs(*batch)
 
 
 @pytest.mark.skipif(
@@ -212,25 +576,21 @@ def live_clean_metadata(container_client: ContainerClient, metadata: Path) -> No
     ],
     indirect=True,
 )
-def test_live_organiser(rpm_packages) -> None:
+def test_live_organiser(
+    rpm_packages, container_client: ContainerClient, worker_prefix: Path
+) -> None:
     """Test that the AzureDistributionOrganiser can find packages."""
-    rpm_package = rpm_packages[0]
-    credential = DefaultAzureCredential()
-    container_client = ContainerClient.from_container_url(
-        container_url=os.environ["BLOB_CONTAINER_URL"],
-        credential=credential,
-    )
+    # Read the package's headers once, for every helper to share
+    rpm_package = LocalRpmPackage(rpm_packages[0])
     upload_directory = "upload"
 
     # Now check that the file is listed
     organiser = AzureDistributionOrganiser(
-        container_client, Path("."), upload_directory=upload_directory
+        container_client, worker_prefix, upload_directory=upload_directory
     )
 
     # Clean the container and upload the package
-    live_clean_and_upload_package(
-        rpm_package, organiser, upload_directory=upload_directory
-    )
+    live_clean_and_upload_package(rpm_package, organiser)
 
     # List the packages in upload/
     packages = organiser.list_uploads()
@@ -238,7 +598,7 @@ def test_live_organiser(rpm_packages) -> None:
     # Ensure that there's one package, and it's the one we uploaded
     assert len(packages) == 1
     package = packages[0]
-    assert package.package_filename() == rpm_package.name
+    assert package.package_filename() == rpm_package.package_filename()
 
     # Check that we can organise the package
     organiser.organise()
@@ -274,38 +634,39 @@ def test_live_organiser(rpm_packages) -> None:
     ],
     indirect=True,
 )
-def test_live_repository(rpm_packages) -> None:
+def test_live_repository(
+    rpm_packages, container_client: ContainerClient, worker_prefix: Path
+) -> None:
     """Test that the AzureDistributionRepository works."""
-    credential = DefaultAzureCredential()
-    container_client = ContainerClient.from_container_url(
-        container_url=os.environ["BLOB_CONTAINER_URL"],
-        credential=credential,
-    )
     upload_directory = "upload"
+    repodata = worker_prefix / "cm" / "2" / "repodata"
+
+    # Read each package's headers once, for every helper to share
+    packages = [LocalRpmPackage(rpm_package) for rpm_package in rpm_packages]
 
     # Create a new AzureDistributionRepository
     repo = AzureDistributionRepository(
-        container_client, upload_directory=upload_directory
+        container_client, upload_directory=upload_directory, root=worker_prefix
     )
 
     # Clean the container and upload the packages
-    live_clean_metadata(container_client, Path("cm/2/repodata"))
-    for rpm_package in rpm_packages:
-        log.info("Uploading package %s", rpm_package)
-        live_clean_and_upload_package(
-            rpm_package, repo.organiser, upload_directory=upload_directory
-        )
+    live_clean_metadata(container_client, repodata)
+    log.info("Uploading packages %s", rpm_packages)
+    live_clean_and_upload_packages(packages, repo.organiser)
 
     # Kick the repository as if it had been invoked by the function app.
-    repo.process()
+    result = repo.process()
+    assert result.packages_changed
+    assert result.repodata_regenerated
 
-    # Running the process again will only regenerate the repository data.
-    repo.process()
+    # Nothing has changed, so running the process again has nothing to do.
+    result = repo.process()
+    assert not result.packages_changed
+    assert not result.repodata_regenerated
 
     # Clean up the repository
-    live_clean_metadata(container_client, Path("cm/2/repodata"))
-    for rpm_package in rpm_packages:
-        live_clean_package(rpm_package, repo.organiser, assert_exists=True)
+    live_clean_metadata(container_client, repodata)
+    live_clean_packages(packages, repo.organiser, assert_exists=True)
 
 
 @pytest.mark.skipif(
@@ -335,25 +696,25 @@ def test_live_repository(rpm_packages) -> None:
     ],
     indirect=True,
 )
-def test_live_flat_repository(rpm_packages) -> None:
+def test_live_flat_repository(
+    rpm_packages, container_client: ContainerClient, worker_prefix: Path
+) -> None:
     """Test that the AzureFlatRepository works."""
-    credential = DefaultAzureCredential()
-    container_client = ContainerClient.from_container_url(
-        container_url=os.environ["BLOB_CONTAINER_URL"],
-        credential=credential,
-    )
     upload_directory = "upload"
+    repodata = worker_prefix / "repodata"
+
+    # Read each package's headers once, for every helper to share
+    packages = [LocalRpmPackage(rpm_package) for rpm_package in rpm_packages]
 
     # Create a new AzureFlatRepository
-    repo = AzureFlatRepository(container_client, upload_directory=upload_directory)
+    repo = AzureFlatRepository(
+        container_client, upload_directory=upload_directory, root=worker_prefix
+    )
 
     # Clean the container and upload the packages
-    live_clean_metadata(container_client, Path("./repodata"))
-    for rpm_package in rpm_packages:
-        log.info("Uploading package %s", rpm_package)
-        live_clean_and_upload_package(
-            rpm_package, repo.organiser, upload_directory=upload_directory
-        )
+    live_clean_metadata(container_client, repodata)
+    log.info("Uploading packages %s", rpm_packages)
+    live_clean_and_upload_packages(packages, repo.organiser)
 
     # Kick the repository as if it had been invoked by the function app.
     repo.process()
@@ -362,6 +723,5 @@ def test_live_flat_repository(rpm_packages) -> None:
     # repo.process()
 
     # # Clean up the repository
-    # live_clean_metadata(container_client, Path("./repodata"))
-    # for rpm_package in rpm_packages:
-    #     live_clean_package(rpm_package, repo.organiser, assert_exists=True)
+    # live_clean_metadata(container_client, repodata)
+    # live_clean_packages(packages, repo.organiser, assert_exists=True)